@@ -10,18 +10,23 @@ from __future__ import annotations
 
 import os
 import re
-import json
+import csv
+import time
 import base64
 import calendar
 from io import StringIO
-from datetime import datetime, timedelta
-from typing import Any, Dict, List, Optional, Tuple
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple
 
+import numpy as np
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from fastapi import APIRouter
 from pydantic import BaseModel
 
-from store import list_invoices_for_user, coerce_legacy
+from store import list_invoices_for_user, coerce_legacy, user_version
 
 router = APIRouter()
 
@@ -57,77 +62,109 @@ class ChatResponse(BaseModel):
 MONTHS_MAP_EN = {m.lower(): i for i, m in enumerate(calendar.month_name) if m}
 ABBR_MAP_EN   = {m.lower(): i for i, m in enumerate(calendar.month_abbr) if m}
 
-def parse_month(query: str) -> Optional[Tuple[int, int]]:
+# "<month> <yyyy>" patterns, compiled once per full name / abbreviation
+_MONTH_RES = {
+    name: re.compile(rf"{re.escape(name)}\s+(\d{{4}})")
+    for name in {**MONTHS_MAP_EN, **ABBR_MAP_EN}
+}
+
+# Month lookup priority: full names (Jan..Dec), then abbreviations
+_MONTH_KEYS = tuple(MONTHS_MAP_EN) + tuple(ABBR_MAP_EN)
+_MONTH_INDEX = {**MONTHS_MAP_EN, **ABBR_MAP_EN}
+
+ROUTE_KEYWORDS = (
+    "this month", "last month", "risky", "month", "total", "spent", "amount",
+    "export", "csv", "tax", "vat", "summary", "report",
+)
+
+# Every keyword routing or month parsing looks at; plain substring tests (C
+# speed) beat a single regex alternation for a short question.
+_SCAN_KEYS = tuple(dict.fromkeys((*ROUTE_KEYWORDS, *_MONTH_KEYS)))
+
+
+def scan_keywords(text: str) -> Set[str]:
+    """Return every route/month keyword occurring in (lowercased) text."""
+    return {k for k in _SCAN_KEYS if k in text}
+
+
+def parse_month(query: str, hits: Optional[Set[str]] = None) -> Optional[Tuple[int, int]]:
     """Extract (year, month) from English query: “this/last month”, “Aug 2025”, “August”"""
     q = query.lower()
-    now = datetime.utcnow()
+    if hits is None:
+        hits = scan_keywords(q)
+    now = datetime.now(timezone.utc)
 
-    if "this month" in q:
+    if "this month" in hits:
         return (now.year, now.month)
-    if "last month" in q:
+    if "last month" in hits:
         prev = (now.replace(day=1) - timedelta(days=1))
         return (prev.year, prev.month)
 
-    for name, mi in MONTHS_MAP_EN.items():
-        if name in q:
-            m = re.search(rf"{name}\s+(\d{{4}})", q)
-            return (int(m.group(1)) if m else now.year, mi)
-
-    for name, mi in ABBR_MAP_EN.items():
-        if name and name in q:
-            m = re.search(rf"{name}\s+(\d{{4}})", q)
-            return (int(m.group(1)) if m else now.year, mi)
+    for name in _MONTH_KEYS:
+        if name in hits:
+            m = _MONTH_RES[name].search(q)
+            return (int(m.group(1)) if m else now.year, _MONTH_INDEX[name])
 
     return None
 
 
-def filter_by_month(invs: List[Dict[str, Any]], y: int, m: int) -> List[Dict[str, Any]]:
-    """Filter invoices by month using 'date' (dd.mm.yyyy, etc.) or 'createdAt' ISO."""
-    out: List[Dict[str, Any]] = []
-    for d in invs:
-        dt = d.get("date")
-        try:
-            if dt and re.match(r"\d{1,2}[./-]\d{1,2}[./-]\d{2,4}", dt):
-                dd, mm, yy = re.split(r"[./-]", dt)[:3]
-                if len(yy) == 2:
-                    yy = "20" + yy
-                if int(yy) == y and int(mm) == m:
-                    out.append(d)
-                    continue
-        except Exception:
-            pass
+class InvoiceArrays(NamedTuple):
+    """Column (struct-of-arrays) view of an invoice list; -1 marks an unknown year/month."""
+    amount: np.ndarray
+    vat: np.ndarray
+    fraud: np.ndarray
+    year: np.ndarray
+    month: np.ndarray
+
 
-        ca = d.get("createdAt")
-        try:
-            if ca and int(ca[0:4]) == y and int(ca[5:7]) == m:
-                out.append(d)
-        except Exception:
-            pass
-    return out
+def to_arrays(invs: List[Dict[str, Any]]) -> InvoiceArrays:
+    """Build the column view once so month filters and totals run as NumPy reductions."""
+    n = len(invs)
 
+    def col(key: str, dtype: Any, missing: Any) -> np.ndarray:
+        return np.fromiter(((d.get(key) or missing) for d in invs), dtype=dtype, count=n)
 
-def sum_amount(invs: List[Dict[str, Any]]) -> float:
-    return round(sum((d.get("amount") or 0) for d in invs), 2)
+    return InvoiceArrays(
+        amount=col("amount", np.float64, 0.0),
+        vat=col("vat", np.float64, 0.0),
+        fraud=col("fraud_score", np.float64, 0.0),
+        year=col("_year", np.int32, -1),  # precomputed by store.coerce_legacy
+        month=col("_month", np.int32, -1),
+    )
 
 
-def sum_vat(invs: List[Dict[str, Any]]) -> float:
-    return round(sum((d.get("vat") or 0) for d in invs), 2)
+def filter_by_month(arr: InvoiceArrays, y: int, m: int) -> np.ndarray:
+    """Mask of invoices in (y, m) by 'date', falling back to 'createdAt'."""
+    return (arr.year == y) & (arr.month == m)
 
 
-def risky(invs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    return [d for d in invs if (d.get("fraud_score") or 0) >= 0.7]
+def sum_amount(arr: InvoiceArrays, mask: Optional[np.ndarray] = None) -> float:
+    values = arr.amount if mask is None else arr.amount[mask]
+    return round(float(values.sum()), 2)
 
 
+def sum_vat(arr: InvoiceArrays, mask: Optional[np.ndarray] = None) -> float:
+    values = arr.vat if mask is None else arr.vat[mask]
+    return round(float(values.sum()), 2)
+
+
+def risky(arr: InvoiceArrays) -> np.ndarray:
+    return arr.fraud >= 0.7
+
+
+def select(invs: List[Dict[str, Any]], mask: np.ndarray) -> List[Dict[str, Any]]:
+    """Invoices whose mask entry is set, in original order."""
+    return [invs[i] for i in np.flatnonzero(mask)]
+
+
+CSV_COLUMNS = ("date", "vendor", "currency", "amount", "vat", "filename")
+
 def build_tax_csv(invs: List[Dict[str, Any]]) -> str:
-    """Build a simple CSV for tax export (no quoting to keep it lightweight)."""
+    """Build a simple CSV for tax export (csv module handles quoting)."""
     buf = StringIO()
-    buf.write("date,vendor,currency,amount,vat,filename\n")
-    for d in invs:
-        vendor = (d.get("vendor") or "").replace(",", " ")
-        buf.write(
-            f"{d.get('date') or ''},{vendor},{d.get('currency') or ''},"
-            f"{d.get('amount') or ''},{d.get('vat') or ''},{d.get('filename') or ''}\n"
-        )
+    w = csv.writer(buf, lineterminator="\n")
+    w.writerow(CSV_COLUMNS)
+    w.writerows(tuple(d.get(k) or "" for k in CSV_COLUMNS) for d in invs)
     return buf.getvalue()
 
 
@@ -139,19 +176,48 @@ OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
 # Choose a model available on OpenRouter; gpt-4o-mini via OpenRouter alias:
 OPENROUTER_MODEL = os.environ.get("OPENROUTER_MODEL", "openai/gpt-4o-mini")
 
+# One pooled session for all LLM calls: keeps TCP/TLS connections alive between
+# chat requests instead of paying a fresh handshake per question.
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=20,
+        pool_maxsize=100,
+        # The completion POST is paid and not idempotent: retry only when the
+        # request never reached the model (connect errors, 429/503 rejections),
+        # never after a read timeout or a 5xx that may already have been billed.
+        max_retries=Retry(
+            total=2,
+            connect=2,
+            read=0,
+            status=2,
+            backoff_factor=0.2,
+            status_forcelist=[429, 503],
+            allowed_methods=frozenset({"POST"}),
+            respect_retry_after_header=False,  # keep worst-case latency bounded
+        ),
+    ),
+)
+_SESSION.headers.update({
+    "HTTP-Referer": OPENROUTER_SITE,
+    "X-Title": OPENROUTER_TITLE,
+    "Content-Type": "application/json",
+})
+if OPENROUTER_API_KEY:
+    _SESSION.headers["Authorization"] = f"Bearer {OPENROUTER_API_KEY}"
+
+def _context_json(context: Dict[str, Any], max_bytes: int = 4000) -> str:
+    """Serialize the LLM context with orjson and cap it at max_bytes (UTF-8 safe)."""
+    return orjson.dumps(context)[:max_bytes].decode("utf-8", "ignore")
+
 def llm_answer(question: str, context: Dict[str, Any]) -> Optional[str]:
     """Ask an LLM via OpenRouter using only provided context; return text or None."""
     if not OPENROUTER_API_KEY:
         return None
     try:
-        resp = requests.post(
+        resp = _SESSION.post(
             OPENROUTER_URL,
-            headers={
-                "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-                "HTTP-Referer": OPENROUTER_SITE,
-                "X-Title": OPENROUTER_TITLE,
-                "Content-Type": "application/json",
-            },
             json={
                 "model": OPENROUTER_MODEL,
                 "messages": [
@@ -161,7 +227,7 @@ def llm_answer(question: str, context: Dict[str, Any]) -> Optional[str]:
                     },
                     {
                         "role": "user",
-                        "content": f"Question: {question}\n\nContext JSON:\n{json.dumps(context)[:4000]}",
+                        "content": f"Question: {question}\n\nContext JSON:\n{_context_json(context)}",
                     },
                 ],
                 "temperature": 0.2,
@@ -175,6 +241,45 @@ def llm_answer(question: str, context: Dict[str, Any]) -> Optional[str]:
         return None
 
 
+# ---------------- Per-user invoice cache ----------------
+# Users tend to ask several questions in a row; keep their coerced invoice list
+# (and its column view) for a few seconds instead of re-reading/normalizing it
+# on every chat turn. Entries are also dropped as soon as store.save_invoice
+# bumps the user version.
+CHAT_CACHE_TTL = float(os.environ.get("CHAT_CACHE_TTL", "10"))
+CHAT_CACHE_MAX_USERS = 1024
+_USER_CACHE: Dict[str, Tuple[float, int, List[Dict[str, Any]], InvoiceArrays]] = {}
+
+def user_invoices(user_id: str) -> Tuple[List[Dict[str, Any]], InvoiceArrays]:
+    """Coerced invoices for a user plus their column view, served from a short-lived cache."""
+    now = time.monotonic()
+    version = user_version(user_id)
+    hit = _USER_CACHE.get(user_id)
+    if hit and hit[1] == version and now - hit[0] < CHAT_CACHE_TTL:
+        return hit[2], hit[3]
+
+    docs = [coerce_legacy(d) for d in list_invoices_for_user(user_id)]
+    arr = to_arrays(docs)
+    if user_id not in _USER_CACHE and len(_USER_CACHE) >= CHAT_CACHE_MAX_USERS:
+        _USER_CACHE.pop(next(iter(_USER_CACHE)), None)  # evict oldest entry
+    _USER_CACHE[user_id] = (now, version, docs, arr)
+    return docs, arr
+
+
+def llm_context(docs: List[Dict[str, Any]], arr: InvoiceArrays) -> Dict[str, Any]:
+    """Summary + first 20 invoices handed to the LLM fallback."""
+    return {
+        "count": len(docs),
+        "total_amount": sum_amount(arr),
+        "total_vat": sum_vat(arr),
+        "risky_count": int(risky(arr).sum()),
+        "sample": [
+            {k: d.get(k) for k in ("id", "filename", "vendor", "date", "amount", "currency", "vat", "fraud_score")}
+            for d in docs[:20]
+        ],
+    }
+
+
 # ---------------- Route ----------------
 @router.post("/chat", response_model=ChatResponse)
 def chat(req: ChatRequest) -> ChatResponse:
@@ -185,55 +290,49 @@ def chat(req: ChatRequest) -> ChatResponse:
       - "Export my tax summary"
     """
     q = req.question.strip()
-    docs = [coerce_legacy(d) for d in list_invoices_for_user(req.userId)]
-
-    ctx = {
-        "count": len(docs),
-        "total_amount": sum_amount(docs),
-        "total_vat": sum_vat(docs),
-        "risky_count": len(risky(docs)),
-        "sample": [
-            {k: d.get(k) for k in ("id", "filename", "vendor", "date", "amount", "currency", "vat", "fraud_score")}
-            for d in docs[:20]
-        ],
-    }
-
     ql = q.lower()
+    hits = scan_keywords(ql)
+    # Route first: invoices are loaded only by the branches that use them
 
     # Risky invoices this month
-    if "risky" in ql and "month" in ql:
-        y, m = parse_month(q) or (datetime.utcnow().year, datetime.utcnow().month)
-        sub = filter_by_month(docs, y, m)
-        rsk = risky(sub)
+    if "risky" in hits and "month" in hits:
+        docs, arr = user_invoices(req.userId)
+        now = datetime.now(timezone.utc)
+        y, m = parse_month(q, hits) or (now.year, now.month)
+        rsk = select(docs, filter_by_month(arr, y, m) & risky(arr))
         ans = f"{calendar.month_name[m]} {y} risky invoices: {len(rsk)}"
         return ChatResponse(answer=ans, invoices=[InvoiceOut(**d) for d in rsk])
 
     # Total spent in <Month>
-    if "total" in ql and ("spent" in ql or "amount" in ql):
-        ym = parse_month(q)
+    if "total" in hits and ("spent" in hits or "amount" in hits):
+        _, arr = user_invoices(req.userId)
+        ym = parse_month(q, hits)
         if ym:
             y, m = ym
-            sub = filter_by_month(docs, y, m)
-            ans = f"Total spent in {calendar.month_name[m]} {y}: ${sum_amount(sub):,.2f}"
+            total = sum_amount(arr, filter_by_month(arr, y, m))
+            ans = f"Total spent in {calendar.month_name[m]} {y}: ${total:,.2f}"
             return ChatResponse(answer=ans)
-        return ChatResponse(answer=f"All-time total: ${ctx['total_amount']:,.2f}")
+        return ChatResponse(answer=f"All-time total: ${sum_amount(arr):,.2f}")
 
     # Export tax summary (CSV)
-    if "export" in ql or "csv" in ql or "tax" in ql or "vat" in ql or "summary" in ql or "report" in ql:
-        ym = parse_month(q)
+    if hits & {"export", "csv", "tax", "vat", "summary", "report"}:
+        docs, arr = user_invoices(req.userId)
+        ym = parse_month(q, hits)
         sub, label = (docs, "all-time")
         if ym:
             y, m = ym
-            sub = filter_by_month(docs, y, m)
+            sub = select(docs, filter_by_month(arr, y, m))
             label = f"{calendar.month_name[m]} {y}"
         csv_text = build_tax_csv(sub)
         b64 = base64.b64encode(csv_text.encode("utf-8")).decode("ascii")
         return ChatResponse(answer=f"Generated tax CSV for {label}.", csv_base64=b64)
 
     # Fallback to LLM (if configured)
-    llm = llm_answer(q, ctx)
-    if llm:
-        return ChatResponse(answer=llm)
+    if OPENROUTER_API_KEY:
+        docs, arr = user_invoices(req.userId)
+        llm = llm_answer(q, llm_context(docs, arr))
+        if llm:
+            return ChatResponse(answer=llm)
 
     # Final fallback
     return ChatResponse(
@@ -5,34 +5,46 @@
 # - Simple extraction + language + type + fraud + VAT guess
 # - Endpoints: /upload_invoice, /invoices, /users/sync, /users/logins, /chat
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, Query, Form
+from fastapi import FastAPI, UploadFile, File, HTTPException, Query, Form, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
-from datetime import datetime
-import io, os, re, uuid, tempfile
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import io, os, re, tempfile, threading
 
-from PIL import Image, UnidentifiedImageError
+from PIL import Image, ImageOps, UnidentifiedImageError
 import pytesseract
-from pdf2image import convert_from_path
+from pdf2image import convert_from_bytes
 
 import shutil, pytesseract
 pytesseract.pytesseract.tesseract_cmd = shutil.which("tesseract") or "/usr/bin/tesseract"
 
-# Optional language detection
+# Optional in-process Tesseract (libtesseract bindings); falls back to pytesseract
 try:
-    from langdetect import detect as lang_detect
+    from tesserocr import PyTessBaseAPI
+except Exception:
+    PyTessBaseAPI = None
+
+# Optional language detection (seeded so results, and cache entries, are stable)
+try:
+    from langdetect import DetectorFactory, detect as lang_detect
+    DetectorFactory.seed = 0
 except Exception:
     lang_detect = None
 
 # Use the single persistence layer from store.py
 from store import (
-    DB as STORE_DB,
-    FIREBASE_READY as STORE_FIREBASE_READY,
+    firestore_db,
     MEM_STORE as STORE_MEM,
     save_invoice,
     get_invoice,
     list_invoices_for_user,
+    list_invoices_page,
+    list_invoices_summary,
+    new_invoice_id,
     coerce_legacy,
 )
 
@@ -57,6 +69,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],  # Content-Type, Authorization vs. hepsi
+    expose_headers=["X-Next-Cursor"],  # tarayıcı JS'i sayfalama imlecini okuyabilsin
 )
 # ------------------------------------------------------------------------------
 # Models (match frontend)
@@ -76,6 +89,19 @@ class InvoiceOut(BaseModel):
     language: Optional[str] = None   # ISO-639-1 (e.g. 'en')
     docType: Optional[str] = None    # 'recurring' | 'service' | 'product' | 'other'
 
+class InvoiceSummaryOut(BaseModel):
+    """Listing row: InvoiceOut without ocr_text/vat/language."""
+    id: str
+    userId: str
+    filename: str
+    vendor: Optional[str] = None
+    date: Optional[str] = None
+    amount: Optional[float] = None
+    currency: Optional[str] = None
+    fraud_score: Optional[float] = None
+    createdAt: Optional[str] = None
+    docType: Optional[str] = None
+
 class UserIn(BaseModel):
     userId: str
     email: Optional[str] = None
@@ -90,8 +116,24 @@ class LoginEvent(BaseModel):
 # ------------------------------------------------------------------------------
 # OCR helpers
 # ------------------------------------------------------------------------------
+# OCR_WORKERS pages are OCR'd in parallel (tesserocr releases the GIL,
+# pytesseract runs a tesseract subprocess per page). OCR_WORKERS=1 OCRs one
+# page at a time, e.g. on small dev machines; it still runs on the pool.
+OCR_WORKERS = int(os.environ.get("OCR_WORKERS", str(os.cpu_count() or 1)))
+# All OCR runs on this pool (never on the request threads), so at most
+# OCR_WORKERS tesserocr APIs / loaded models exist per process.
+_OCR_POOL = ThreadPoolExecutor(max_workers=max(1, OCR_WORKERS), thread_name_prefix="ocr")
+# 200 DPI keeps printed-invoice accuracy with ~2.25x fewer pixels than 300
+OCR_DPI = int(os.environ.get("OCR_DPI", "200"))
+# Upload bounds: reject huge files before OCR, only rasterize the first pages
+MAX_UPLOAD_MB = int(os.environ.get("MAX_UPLOAD_MB", "20"))
+OCR_MAX_PAGES = int(os.environ.get("OCR_MAX_PAGES", "10"))
+# LSTM engine + single text block (invoice layout): fewer segmenter passes than psm 3
+OCR_LANG = os.environ.get("OCR_LANG", "eng")
+OCR_CONFIG = os.environ.get("OCR_CONFIG", "--oem 1 --psm 6")
+
 def _open_image_resilient(content: bytes) -> Image.Image:
-    """Open image from bytes; fallback to temp file; normalize mode."""
+    """Open image from bytes; fallback to temp file; normalize to grayscale."""
     try:
         img = Image.open(io.BytesIO(content))
     except UnidentifiedImageError:
@@ -102,34 +144,82 @@ def _open_image_resilient(content: bytes) -> Image.Image:
             img = Image.open(tmp_path)
         finally:
             os.unlink(tmp_path)
-    if img.mode not in ("RGB", "L"):
-        img = img.convert("RGB")
+    if img.mode != "L":
+        img = img.convert("L")  # tesseract binarizes anyway; 1/3 of the RGB bytes
     return img
 
+def _otsu_threshold(img: Image.Image) -> int:
+    """Otsu threshold of an L image, computed from its 256-bin histogram."""
+    hist = img.histogram()
+    total = sum(hist)
+    sum_all = sum(i * h for i, h in enumerate(hist))
+    weight_bg = sum_bg = 0
+    best_t, best_var = 127, -1.0
+    for t, h in enumerate(hist):
+        weight_bg += h
+        if weight_bg == 0:
+            continue
+        weight_fg = total - weight_bg
+        if weight_fg == 0:
+            break
+        sum_bg += t * h
+        mean_bg = sum_bg / weight_bg
+        mean_fg = (sum_all - sum_bg) / weight_fg
+        var = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+        if var > best_var:
+            best_t, best_var = t, var
+    return best_t
+
+def _prep_for_ocr(img: Image.Image) -> Image.Image:
+    """Grayscale + autocontrast + Otsu binarization: cleaner, faster input for tesseract."""
+    if img.mode != "L":
+        img = img.convert("L")
+    img = ImageOps.autocontrast(img)
+    t = _otsu_threshold(img)
+    return img.point(lambda p: 255 if p > t else 0)
+
+# tesserocr keeps the model loaded between pages/requests; one API per thread
+# since PyTessBaseAPI is not thread-safe. Only _OCR_POOL workers call this.
+_TESS_LOCAL = threading.local()
+_TESS_MODES = {k: int(v) for k, v in re.findall(r"--(psm|oem)\s+(\d+)", OCR_CONFIG)}
+
+def _tess_api():
+    api = getattr(_TESS_LOCAL, "api", None)
+    if api is None:
+        api = PyTessBaseAPI(lang=OCR_LANG, psm=_TESS_MODES.get("psm", 3), oem=_TESS_MODES.get("oem", 3))
+        _TESS_LOCAL.api = api
+    return api
+
+def _ocr_image(img: Image.Image) -> str:
+    img = _prep_for_ocr(img)
+    if PyTessBaseAPI is not None:
+        api = _tess_api()
+        api.SetImage(img)
+        return api.GetUTF8Text()
+    return pytesseract.image_to_string(img, lang=OCR_LANG, config=OCR_CONFIG)
+
 def ocr_bytes_to_texts(data: bytes, filename: Optional[str] = None) -> list[str]:
     """
     Bytes içeriği (PDF/PNG/JPG) OCR eder.
-    PDF ise geçici dosyaya yazıp convert_from_path ile sayfalara çevirir.
-    Görsellerde direkt pytesseract uygulanır.
+    PDF ise convert_from_bytes ile doğrudan sayfalara çevirir.
+    Görseller ikili (siyah/beyaz) hale getirilip pytesseract'a verilir.
     """
     texts: list[str] = []
     name = (filename or "").lower()
 
     try:
         if name.endswith(".pdf"):
-            # PDF → temp dosya → sayfa resimleri
-            with tempfile.NamedTemporaryFile(suffix=".pdf", delete=True) as tf:
-                tf.write(data)
-                tf.flush()
-                pages = convert_from_path(tf.name, 300)  # poppler-utils gerekir
-            for img in pages:
-                txt = pytesseract.image_to_string(img)
-                if txt:
-                    texts.append(txt)
+            # PDF bytes → sayfa resimleri
+            pages = convert_from_bytes(  # poppler-utils gerekir
+                data, dpi=OCR_DPI, grayscale=True, thread_count=OCR_WORKERS,
+                first_page=1, last_page=OCR_MAX_PAGES,
+            )
+            # Sayfaları OCR havuzunda paralel OCR et (sıra korunur)
+            texts.extend(txt for txt in _OCR_POOL.map(_ocr_image, pages) if txt)
         else:
             # PNG/JPG → direkt
             img = _open_image_resilient(data)
-            txt = pytesseract.image_to_string(img)
+            txt = _OCR_POOL.submit(_ocr_image, img).result()
             if txt:
                 texts.append(txt)
     except UnidentifiedImageError:
@@ -138,43 +228,67 @@ def ocr_bytes_to_texts(data: bytes, filename: Optional[str] = None) -> list[str]
 
     return texts
 
+def _iso_now() -> str:
+    """UTC now as ISO-8601 with a trailing Z."""
+    return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+
 # ------------------------------------------------------------------------------
 # AI helpers (lang, type, parsers, fraud, VAT)
 # ------------------------------------------------------------------------------
-def detect_language(text: str) -> Optional[str]:
-    """Detect language of the text and return ISO-639-1 code."""
-    if not text:
-        return None
+LANG_PREFIX_CHARS = 512  # invoice headers decide the language; enough for langdetect
+LANG_MIN_CHARS = 20      # below this detection is unreliable anyway
+
+@lru_cache(maxsize=2048)
+def _detect_lang_cached(prefix: str) -> Optional[str]:
     try:
         if lang_detect:
-            return lang_detect(text)
+            return lang_detect(prefix)
     except Exception:
         pass
     return None
 
-def classify_doc_type(text: str) -> str:
-    """Simple invoice classifier."""
-    t = text.lower()
-    if any(w in t for w in ["subscription", "monthly", "recurring"]):
-        return "recurring"
-    if any(w in t for w in ["consulting", "service", "maintenance"]):
-        return "service"
-    if any(w in t for w in ["item", "product", "goods", "pcs", "sku", "unit price"]):
-        return "product"
+def detect_language(text: str) -> Optional[str]:
+    """Detect language of the text and return ISO-639-1 code."""
+    if not text or len(text.strip()) < LANG_MIN_CHARS:
+        return None
+    return _detect_lang_cached(text[:LANG_PREFIX_CHARS])
+
+# Checked in this order: the first type with any keyword hit wins
+DOC_TYPE_KEYWORDS = {
+    "recurring": ("subscription", "monthly", "recurring"),
+    "service": ("consulting", "service", "maintenance"),
+    "product": ("item", "product", "goods", "pcs", "sku", "unit price"),
+}
+
+def classify_doc_type(lower_text: str) -> str:
+    """Simple invoice classifier over already-lowercased text (first matching type wins)."""
+    for doc_type, words in DOC_TYPE_KEYWORDS.items():
+        if any(w in lower_text for w in words):
+            return doc_type
     return "other"
 
 CURRENCY_SIGNS = {"€": "EUR", "£": "GBP", "$": "USD"}
+CURRENCY_CODES = ("EUR", "USD", "GBP", "TRY")
+RED_FLAGS = ("pay by gift card", "urgent", "wire immediately", "overdue fee 50%")
 DATE_PAT = re.compile(r"(\b\d{1,2}[./-]\d{1,2}[./-]\d{2,4}\b|\b\d{4}[./-]\d{1,2}[./-]\d{1,2}\b)")
 AMOUNT_PAT = re.compile(r"(?<!\w)(?:USD|EUR|GBP|\$|€|£)?\s*([0-9]{1,3}(?:[.,][0-9]{3})*(?:[.,][0-9]{2})?)")
+VAT_RATE_PAT = re.compile(r"(\d{1,2}(?:\.\d)?)\s*%")
 
-def detect_currency(text: str) -> Optional[str]:
-    for sign, cur in CURRENCY_SIGNS.items():
-        if sign in text:
-            return cur
-    for cur in ("EUR", "USD", "GBP", "TRY"):
-        if cur in text:
-            return cur
-    return None
+def scan_text(text: str, lower: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Collect the markers the parsers need with C-level substring scans:
+    currency (signs win over codes, case-sensitive), distinct red flags and
+    VAT/tax mention (case-insensitive). Pass `lower` if text.lower() is at hand.
+    """
+    t = text.lower() if lower is None else lower
+    currency = next((cur for sign, cur in CURRENCY_SIGNS.items() if sign in text), None)
+    if currency is None:
+        currency = next((cur for cur in CURRENCY_CODES if cur in text), None)
+    return {
+        "currency": currency,
+        "red_flags": {flag for flag in RED_FLAGS if flag in t},
+        "mentions_tax": "vat" in t or "tax" in t,
+    }
 
 def parse_amount(text: str) -> Optional[float]:
     candidates = []
@@ -207,25 +321,72 @@ def pick_vendor(text: str) -> Optional[str]:
             return line.strip()
     return None
 
-def fraud_score(text: str, amount: Optional[float]) -> float:
+def fraud_score(red_flags: set[str], amount: Optional[float]) -> float:
     score = 0.0
-    red_flags = ["pay by gift card", "urgent", "wire immediately", "overdue fee 50%"]
-    score += sum(1 for f in red_flags if f in text.lower()) * 0.2
+    score += len(red_flags) * 0.2
     if amount is not None and amount > 10000:
         score += 0.3
     return round(min(score, 1.0), 2)
 
-def vat_guess(currency: Optional[str], text: str, amount: Optional[float]) -> Optional[float]:
+def vat_guess(currency: Optional[str], text: str, amount: Optional[float], mentions_tax: bool) -> Optional[float]:
     """Return VAT amount (not rate) for MVP."""
     rate = None
-    t = text.lower()
-    if "vat" in t or "tax" in t or currency == "EUR":
-        m = re.search(r"(\d{1,2}(?:\.\d)?)\s*%", t)
+    if mentions_tax or currency == "EUR":
+        m = VAT_RATE_PAT.search(text)
         rate = (float(m.group(1)) / 100.0) if m else 0.20
     if amount is not None and rate is not None:
         return round(amount * rate, 2)
     return None
 
+# ------------------------------------------------------------------------------
+# Upload pipeline
+# ------------------------------------------------------------------------------
+def process_invoice(data: bytes, filename: Optional[str], uid: str) -> Dict[str, Any]:
+    """OCR + simple AI pipeline + save; blocking, so routes run it in the threadpool."""
+    # OCR
+    texts = ocr_bytes_to_texts(data, filename=filename)
+    if not texts:
+        raise ValueError("OCR içerik çıkaramadı (format/bağımlılık?).")
+
+    merged = "\n".join(texts)
+
+    lower = merged.lower()
+    scan = scan_text(merged, lower)
+    currency = scan["currency"]
+    amount = parse_amount(merged)
+    vendor = pick_vendor(merged)
+    date_val = None
+    m = DATE_PAT.search(merged)
+    if m:
+        date_val = m.group(1)
+
+    fscore = fraud_score(scan["red_flags"], amount)
+    vat_amount = vat_guess(currency, merged, amount, scan["mentions_tax"])
+    language = detect_language(merged)
+    doc_type = classify_doc_type(lower)
+
+    doc_id = new_invoice_id()
+    created_iso = _iso_now()
+
+    doc = {
+        "id": doc_id,
+        "userId": uid,
+        "filename": filename or "upload",
+        "ocr_text": texts,
+        "vendor": vendor,
+        "date": date_val,
+        "amount": amount,
+        "currency": currency,
+        "vat": vat_amount,
+        "fraud_score": fscore,
+        "createdAt": created_iso,
+        "language": language,
+        "docType": doc_type,
+    }
+
+    save_invoice(doc)
+    return doc
+
 # ------------------------------------------------------------------------------
 # Routes
 # ------------------------------------------------------------------------------
@@ -245,54 +406,28 @@ async def upload_invoice_ep(
     try:
         uid = userId or userId_q or "anonymous"
 
-        # UploadFile içeriğini *async* okuyalım (Render/uvicorn ile daha stabil)
-        data = await file.read()
+        # UploadFile içeriğini *async* ve parça parça okuyalım; limit aşılırsa 413
+        limit = MAX_UPLOAD_MB << 20
+        if file.size is not None and file.size > limit:
+            raise HTTPException(status_code=413, detail=f"File too large (max {MAX_UPLOAD_MB} MB)")
+        chunks, size = [], 0
+        while chunk := await file.read(1 << 20):
+            size += len(chunk)
+            if size > limit:
+                raise HTTPException(status_code=413, detail=f"File too large (max {MAX_UPLOAD_MB} MB)")
+            chunks.append(chunk)
+        data = b"".join(chunks)
         if not data:
             raise ValueError("Boş dosya alındı.")
         await file.seek(0)  # ileride tekrar okunursa sorun çıkmasın
 
-        # OCR
-        texts = ocr_bytes_to_texts(data, filename=file.filename)
-        if not texts:
-            raise ValueError("OCR içerik çıkaramadı (format/bağımlılık?).")
-
-        merged = "\n".join(texts)
-
-        currency = detect_currency(merged)
-        amount = parse_amount(merged)
-        vendor = pick_vendor(merged)
-        date_val = None
-        m = DATE_PAT.search(merged)
-        if m:
-            date_val = m.group(1)
-
-        fscore = fraud_score(merged, amount)
-        vat_amount = vat_guess(currency, merged, amount)
-        language = detect_language(merged)
-        doc_type = classify_doc_type(merged)
-
-        doc_id = uuid.uuid4().hex
-        created_iso = datetime.utcnow().isoformat() + "Z"
-
-        doc = {
-            "id": doc_id,
-            "userId": uid,
-            "filename": file.filename or "upload",
-            "ocr_text": texts,
-            "vendor": vendor,
-            "date": date_val,
-            "amount": amount,
-            "currency": currency,
-            "vat": vat_amount,
-            "fraud_score": fscore,
-            "createdAt": created_iso,
-            "language": language,
-            "docType": doc_type,
-        }
-
-        save_invoice(doc)
+        # OCR + parse + save are blocking (tesseract, langdetect, Firestore RPC):
+        # run them in the threadpool so the event loop keeps serving requests.
+        doc = await run_in_threadpool(process_invoice, data, file.filename, uid)
         return InvoiceOut(**doc)
 
+    except HTTPException:
+        raise
     except Exception as e:
         # Render loglarında net görünsün:
         import traceback
@@ -301,12 +436,41 @@ async def upload_invoice_ep(
         raise HTTPException(status_code=500, detail=f"OCR/parse failed: {e}")
         
 @app.get("/invoices", response_model=List[InvoiceOut])
-def list_invoices_ep(userId: Optional[str] = Query(None, alias="userId")):
-    """List invoices (optionally filtered by userId)."""
+def list_invoices_ep(
+    response: Response,
+    userId: Optional[str] = Query(None, alias="userId"),
+    limit: Optional[int] = Query(None, ge=1, le=500),
+    cursor: Optional[str] = Query(None),
+):
+    """
+    List invoices (optionally filtered by userId), newest first.
+    With `limit`, returns one page and puts the next page's cursor in the
+    X-Next-Cursor header (absent on the last page).
+    """
+    if cursor and not limit:
+        raise HTTPException(status_code=422, detail="cursor requires limit")
+    try:
+        if limit:
+            page = list_invoices_page(userId, page_size=limit, cursor=cursor)
+            if page["next_cursor"]:
+                response.headers["X-Next-Cursor"] = page["next_cursor"]
+            docs = page["items"]
+        else:
+            docs = list_invoices_for_user(userId)
+        # response_model validates + serializes straight to JSON bytes once;
+        # building InvoiceOut objects here would validate every row twice.
+        return [coerce_legacy(d) for d in docs]
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"List failed: {e}")
+
+@app.get("/invoices/summary", response_model=List[InvoiceSummaryOut])
+def list_invoice_summaries_ep(
+    userId: Optional[str] = Query(None, alias="userId"),
+    limit: Optional[int] = Query(None, ge=1, le=500),
+):
+    """Lightweight listing (no OCR text); fetch /invoices/{id} for details."""
     try:
-        docs = list_invoices_for_user(userId)
-        coerced = [coerce_legacy(d) for d in docs]
-        return [InvoiceOut(**d) for d in coerced]
+        return [coerce_legacy(d) for d in list_invoices_summary(userId, limit)]
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"List failed: {e}")
 
@@ -325,10 +489,11 @@ def sync_user(u: UserIn):
         doc = {
             "email": u.email,
             "displayName": u.displayName,
-            "updatedAt": datetime.utcnow().isoformat() + "Z",
+            "updatedAt": _iso_now(),
         }
-        if STORE_FIREBASE_READY and STORE_DB is not None:
-            STORE_DB.collection("users").document(u.userId).set(doc, merge=True)
+        db = firestore_db()
+        if db is not None:
+            db.collection("users").document(u.userId).set(doc, merge=True)
         else:
             STORE_MEM[f"user::{u.userId}"] = doc
         return {"ok": True}
@@ -340,13 +505,14 @@ def sync_user(u: UserIn):
 def log_login(ev: LoginEvent):
     """Append a login/logout event to users/{uid}/logins (or memory fallback)."""
     try:
-        if STORE_FIREBASE_READY and STORE_DB is not None:
-            STORE_DB.collection("users").document(ev.userId)\
+        db = firestore_db()
+        if db is not None:
+            db.collection("users").document(ev.userId)\
                 .collection("logins").add({
                     "ts": ev.ts,
                     "userAgent": ev.userAgent,
                     "type": ev.type or "login",
-                    "createdAt": datetime.utcnow().isoformat() + "Z",
+                    "createdAt": _iso_now(),
                 })
         else:
             STORE_MEM.setdefault(f"log::{ev.userId}", []).append(ev.dict())
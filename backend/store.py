@@ -2,18 +2,51 @@
 # backend/store.py
 """
 Persistence layer for Invoice AI MVP
-- Initializes Firestore if a service account JSON is present (guarded: no double init)
-- Falls back to an in-memory store
-- Exposes: save_invoice, get_invoice, list_invoices_for_user, coerce_legacy
+- Initializes Firestore on first use if a service account JSON is present
+  (guarded: no double init; firebase_admin is never imported without one)
+- Falls back to an in-memory store (optionally persisted to SQLite via STORE_SQLITE_PATH)
+- Firestore writes from save_invoice are queued and committed in WriteBatches
+  by a background thread (flush() drains the queue; also runs at exit).
+  Reads merge in queued/in-flight docs, so a save is visible immediately;
+  failed batches are retried doc by doc and transient failures re-queued.
+- Exposes: save_invoice, save_invoices_bulk, get_invoice, list_invoices_for_user,
+  list_invoices_page (cursor pagination), list_invoices_summary (projected
+  listing without ocr_text), coerce_legacy, InvoiceRecord (slots dataclass view),
+  new_invoice_id, firestore_db, flush,
+  user_version (bumped on every save so callers can invalidate per-user caches)
+- All functions are blocking: call them from sync routes (FastAPI runs those in
+  its threadpool) or via run_in_threadpool from async ones, never directly on
+  the event loop. save_invoice on Firestore only enqueues, so it returns at once.
 """
 
 from __future__ import annotations
 
 import os
-import uuid
+import glob
+import re
+import sqlite3
+import sys
+import secrets
+import atexit
 import logging
-from datetime import datetime
-from typing import Any, Dict, List, Optional
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FuturesTimeout
+from collections import defaultdict
+from itertools import islice
+from datetime import datetime, timezone
+from operator import itemgetter
+from dataclasses import dataclass, field, fields
+from typing import Any, DefaultDict, Dict, List, Optional, Tuple
+
+import orjson
+from sortedcontainers import SortedKeyList
+
+# One instance per process: importing this file as both `store` (backend/ on
+# sys.path) and `backend.store` (repo root) would otherwise create two
+# in-memory stores and two Firestore write queues that silently diverge.
+sys.modules.setdefault("store", sys.modules[__name__])
+sys.modules.setdefault("backend.store", sys.modules[__name__])
 
 # ---------------------------------------------------------------------------
 # Globals
@@ -21,63 +54,223 @@ from typing import Any, Dict, List, Optional
 FIREBASE_READY = False
 DB = None  # Firestore client or None
 MEM_STORE: Dict[str, Dict[str, Any]] = {}  # in-memory fallback
+# Index order: createdAt (_sort_ts), then id so equal timestamps still have a fixed order
+_INDEX_KEY = itemgetter("_sort_ts", "id")
+# userId -> that user's invoices, oldest first
+MEM_LIST: DefaultDict[str, SortedKeyList] = defaultdict(lambda: SortedKeyList(key=_INDEX_KEY))
+MEM_ALL = SortedKeyList(key=_INDEX_KEY)  # every user's invoices, oldest first
+_MEM_LOCK = threading.Lock()
+_USER_VERSIONS: Dict[str, int] = {}  # userId -> write counter (cache invalidation)
 
 # ---------------------------------------------------------------------------
-# Detect new Firestore filtering API (FieldFilter)
+# Firebase init: lazy, so the in-memory path never imports firebase_admin /
+# gRPC / protobuf (saves a noticeable chunk of every cold start and reload)
 # ---------------------------------------------------------------------------
-try:
-    from google.cloud.firestore_v1 import FieldFilter  # new API
-    HAS_FIELD_FILTER = True
-except Exception:
-    HAS_FIELD_FILTER = False
+firestore = None  # firebase_admin.firestore module once initialized
+FieldFilter = None
+HAS_FIELD_FILTER = False
 
-# ---------------------------------------------------------------------------
-# Firebase init (guarded for uvicorn --reload)
-# ---------------------------------------------------------------------------
-try:
-    import firebase_admin
-    from firebase_admin import credentials, firestore
 
+def _find_cred_path() -> Optional[str]:
+    """FIREBASE_CRED, else a likely service account JSON in CWD (runs once, under _ensure_firebase)."""
     cred_path = os.environ.get("FIREBASE_CRED")
     if not cred_path:
-        # Best-effort: look for a likely service account JSON in CWD
-        for name in os.listdir("."):
-            if name.endswith(".json") and ("firebase" in name or "admin" in name):
-                cred_path = os.path.abspath(name)
-                break
+        # Best-effort fallback; set FIREBASE_CRED to skip the directory scan
+        found = glob.glob("*firebase*.json") or glob.glob("*admin*.json")
+        if found:
+            cred_path = os.path.abspath(found[0])
+            print(f"[store] FIREBASE_CRED not set; using {cred_path}")
+    return cred_path if cred_path and os.path.exists(cred_path) else None
+
+
+_FIREBASE_LOCK = threading.Lock()
+_FIREBASE_CHECKED = False
+
+
+def _ensure_firebase() -> bool:
+    """
+    Initialize Firestore on first use; True when DB is ready. Double-checked
+    lock: concurrent first requests (e.g. sign-in fires several at once) must
+    not race the init, or one would fail on "default app already exists".
+    """
+    global _FIREBASE_CHECKED
+    if _FIREBASE_CHECKED:
+        return FIREBASE_READY
+    with _FIREBASE_LOCK:
+        if not _FIREBASE_CHECKED:
+            _init_firebase()
+            _FIREBASE_CHECKED = True
+    return FIREBASE_READY
+
+
+def _init_firebase() -> bool:
+    global DB, FIREBASE_READY, firestore, FieldFilter, HAS_FIELD_FILTER, _RETRYABLE
+    cred_path = _find_cred_path()
+    if not cred_path:
+        print("[store] No service account JSON; using in-memory store.")
+        return False
+    try:
+        import firebase_admin
+        from firebase_admin import credentials
+        from firebase_admin import firestore as _firestore
 
-    if cred_path and os.path.exists(cred_path):
         # Prevent "default app already exists" on reload
         if not getattr(firebase_admin, "_apps", {}):
             firebase_admin.initialize_app(credentials.Certificate(cred_path))
-        DB = firestore.client()
+        DB = _firestore.client()
+        firestore = _firestore
         FIREBASE_READY = True
         print(f"[store] Firestore ready: {cred_path}")
-    else:
-        print("[store] No service account JSON; using in-memory store.")
-except Exception as e:
-    print(f"[store] Firestore disabled ({e}); using in-memory store.")
+    except Exception as e:
+        print(f"[store] Firestore disabled ({e}); using in-memory store.")
+        return False
+
+    try:
+        from google.api_core.exceptions import Aborted, DeadlineExceeded, ServiceUnavailable
+        _RETRYABLE = (Aborted, DeadlineExceeded, ServiceUnavailable)
+    except Exception:
+        pass
+
+    # Detect new Firestore filtering API (FieldFilter)
+    try:
+        from google.cloud.firestore_v1 import FieldFilter as _FieldFilter  # new API
+        FieldFilter, HAS_FIELD_FILTER = _FieldFilter, True
+    except Exception:
+        HAS_FIELD_FILTER = False
+    return True
+
+
+def firestore_db():
+    """Firestore client, or None when running on the in-memory store."""
+    return DB if _ensure_firebase() else None
+
 
 # ---------------------------------------------------------------------------
 # Helpers
 # ---------------------------------------------------------------------------
 
+def new_invoice_id() -> str:
+    """
+    32 random hex chars, same shape as uuid4().hex but without the UUID object.
+    Deliberately not time-ordered: Firestore hotspots on increasing doc ids.
+    """
+    return secrets.token_hex(16)
+
+
 def _iso_now() -> str:
-    return datetime.utcnow().isoformat() + "Z"
+    return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+# Bump when coerce_legacy starts producing different fields, so documents
+# stamped by an older version get normalized again.
+_COERCE_VERSION = 5
+
+# Fields every normalized invoice has; missing keys take these values
+_DEFAULTS: Dict[str, Any] = {
+    "userId": "anonymous",
+    "vendor": None,
+    "date": None,
+    "amount": None,
+    "currency": None,
+    "vat": None,
+    "fraud_score": None,
+    "language": None,
+    "docType": None,
+}
+
+
+def _utc_iso(ts: float) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+def _created_passthrough(created: Any) -> Any:
+    return created
+
+
+def _created_from_datetime(created: datetime) -> str:  # incl. Firestore DatetimeWithNanoseconds
+    return _utc_iso(created.timestamp())
+
+
+def _created_from_number(created: float) -> str:
+    return _utc_iso(float(created))
+
+
+def _created_generic(created: Any) -> Any:
+    if hasattr(created, "timestamp"):  # Firestore Timestamp-like
+        return _utc_iso(created.timestamp())
+    return created
+
+
+# type(createdAt) -> converter; subclasses/other types are resolved once and cached
+_TS_CONVERTERS: Dict[type, Any] = {
+    str: _created_passthrough,
+    datetime: _created_from_datetime,
+    int: _created_from_number,
+    float: _created_from_number,
+}
+
+
+def _norm_created(created: Any) -> Any:
+    """createdAt -> ISO string; strings and unknown types pass through unchanged."""
+    fn = _TS_CONVERTERS.get(type(created))
+    if fn is None:
+        for base in (str, datetime, int, float):
+            if isinstance(created, base):
+                fn = _TS_CONVERTERS[base]
+                break
+        else:
+            fn = _created_generic
+        _TS_CONVERTERS[type(created)] = fn
+    return fn(created)
+
+
+_DATE_YM_RE = re.compile(r"\d{1,2}[./-](?P<month>\d{1,2})[./-](?P<year>\d{2,4})")
+
+
+def _parse_ym(date: Any, created: Any) -> Tuple[Optional[int], Optional[int]]:
+    """
+    (year, month) an invoice belongs to: from 'date' (dd.mm.yyyy, dd/mm/yy, ...)
+    when it parses, else from the ISO 'createdAt'; (None, None) if neither does.
+    """
+    m = _DATE_YM_RE.match(date) if isinstance(date, str) else None
+    if m:
+        yy = m.group("year")
+        return int("20" + yy if len(yy) == 2 else yy), int(m.group("month"))
+    try:
+        return int(created[0:4]), int(created[5:7])
+    except Exception:
+        return None, None
+
+
+# Fields coerce_legacy derives from the others; process-local, never persisted
+# (persisted copies would go stale when a doc is edited, e.g. in the console)
+_DERIVED_FIELDS = ("_year", "_month", "_sort_ts", "_coerced")
+
+
+def _persisted(d: Dict[str, Any]) -> Dict[str, Any]:
+    """The doc as written to Firestore/SQLite: without the derived fields."""
+    return {k: v for k, v in d.items() if k not in _DERIVED_FIELDS}
 
 
 def coerce_legacy(doc: Dict[str, Any]) -> Dict[str, Any]:
     """
     Normalize legacy/loose documents to the schema expected by frontend.
-    Ensures keys exist and types are sane.
+    Ensures keys exist and types are sane. Documents already normalized by
+    this version in this process are returned as-is (no copy); storage never
+    carries the stamp, so docs read back are always normalized afresh.
     """
-    d = dict(doc)
+    if doc.get("_coerced") == _COERCE_VERSION:
+        return doc
+    return _coerce(doc)
 
-    # id
-    d.setdefault("id", d.get("id") or uuid.uuid4().hex)
 
-    # userId
-    d.setdefault("userId", d.get("userId") or "anonymous")
+def _coerce(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """coerce_legacy without the fast path: derived fields are always recomputed."""
+    d = {**_DEFAULTS, **doc}
+
+    # id
+    if not d.get("id"):
+        d["id"] = new_invoice_id()
 
     # ocr_text (from rawText if necessary)
     if "ocr_text" not in d:
@@ -90,94 +283,652 @@ def coerce_legacy(doc: Dict[str, Any]) -> Dict[str, Any]:
             d["ocr_text"] = []
 
     # filename
-    d.setdefault("filename", d.get("sourceName") or "upload")
+    if "filename" not in d:
+        d["filename"] = d.get("sourceName") or "upload"
 
-    # createdAt -> ISO string
+    # createdAt -> ISO string (Firestore listings order by it server-side, so
+    # every stored doc must carry it as a string)
     created = d.get("createdAt")
+    if created is not None:
+        try:
+            created = _norm_created(created)
+        except Exception:
+            pass  # keep the raw value
+    d["createdAt"] = created if isinstance(created, str) and created else _iso_now()
+
+    # month bucket, parsed once here instead of on every chat query
+    d["_year"], d["_month"] = _parse_ym(d.get("date"), d.get("createdAt"))
+    # sort key (ISO strings sort chronologically), so listings never str() per row
+    created = d.get("createdAt")
+    d["_sort_ts"] = created if isinstance(created, str) else str(created or "")
+
+    d["_coerced"] = _COERCE_VERSION
+    return d
+
+
+@dataclass(slots=True)
+class InvoiceRecord:
+    """
+    Attribute-access view of a normalized invoice (no per-instance __dict__,
+    so large batches take less memory than the equivalent dicts).
+    """
+    id: str
+    userId: str = "anonymous"
+    filename: str = "upload"
+    ocr_text: List[str] = field(default_factory=list)
+    vendor: Optional[str] = None
+    date: Optional[str] = None
+    amount: Optional[float] = None
+    currency: Optional[str] = None
+    vat: Optional[float] = None
+    fraud_score: Optional[float] = None
+    createdAt: Optional[str] = None
+    language: Optional[str] = None
+    docType: Optional[str] = None
+
+    @classmethod
+    def from_doc(cls, doc: Dict[str, Any]) -> "InvoiceRecord":
+        d = coerce_legacy(doc)
+        return cls(**{k: d[k] for k in _RECORD_FIELDS})
+
+
+_RECORD_FIELDS = tuple(f.name for f in fields(InvoiceRecord))
+
+# ---------------------------------------------------------------------------
+# In-memory store with a per-user index kept sorted on insert
+# ---------------------------------------------------------------------------
+def _mem_put(d: Dict[str, Any], persist: bool = True) -> None:
+    """Store an invoice and insert it into its user's sorted list."""
+    with _MEM_LOCK:
+        if persist and _SQL is not None:
+            _sql_write([d])
+        old = MEM_STORE.get(d["id"])
+        if isinstance(old, dict):  # overwrite: drop the previous version from the indexes
+            old_lst = MEM_LIST.get(old.get("userId"))
+            if old_lst is not None:
+                old_lst.discard(old)
+            MEM_ALL.discard(old)
+        MEM_STORE[d["id"]] = d
+        MEM_ALL.add(d)
+        MEM_LIST[d["userId"]].add(d)
+
+
+def _newest_first(lst: SortedKeyList, limit: Optional[int]) -> List[Dict[str, Any]]:
+    return lst[:-limit - 1:-1] if limit else lst[::-1]
+
+
+# ---------------------------------------------------------------------------
+# Optional SQLite persistence for the in-memory store
+# ---------------------------------------------------------------------------
+# With STORE_SQLITE_PATH set (e.g. "invoices.db"), in-memory saves are also
+# written to SQLite and reloaded on startup, so restarts/reloads keep data.
+# Reads keep using the in-memory indexes above.
+SQLITE_PATH = os.environ.get("STORE_SQLITE_PATH", "")
+_SQL: Optional[sqlite3.Connection] = None
+
+
+def _sql_open(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS invoices "
+        "(id TEXT PRIMARY KEY, userId TEXT, sortTs TEXT, doc BLOB)"
+    )
+    # Reads are served from memory; only _sql_load's ORDER BY sortTs uses an index.
+    # Earlier versions also created this one: drop it so writes stop maintaining it.
+    conn.execute("DROP INDEX IF EXISTS invoices_user_ts")
+    conn.execute("CREATE INDEX IF NOT EXISTS invoices_ts ON invoices (sortTs)")
+    return conn
+
+
+def _sql_write(docs: List[Dict[str, Any]]) -> None:
+    """Upsert docs in one transaction (callers hold _MEM_LOCK)."""
+    rows = [(d["id"], d["userId"], d["_sort_ts"], orjson.dumps(_persisted(d), default=str)) for d in docs]
+    _SQL.execute("BEGIN")
     try:
-        if hasattr(created, "timestamp"):  # Firestore Timestamp
-            d["createdAt"] = datetime.utcfromtimestamp(created.timestamp()).isoformat() + "Z"
-        elif isinstance(created, datetime):
-            d["createdAt"] = created.isoformat() + "Z"
-        elif isinstance(created, (int, float)):
-            d["createdAt"] = datetime.utcfromtimestamp(float(created)).isoformat() + "Z"
+        _SQL.executemany("INSERT OR REPLACE INTO invoices VALUES (?, ?, ?, ?)", rows)
     except Exception:
-        # if anything goes wrong, just set below
-        pass
-    d.setdefault("createdAt", _iso_now())
+        _SQL.execute("ROLLBACK")
+        raise
+    _SQL.execute("COMMIT")
 
-    # optional numeric/text fields
-    d.setdefault("vendor", None)
-    d.setdefault("date", None)
-    d.setdefault("amount", None)
-    d.setdefault("currency", None)
-    d.setdefault("vat", None)
-    d.setdefault("fraud_score", None)
 
-    return d
+def _sql_load() -> int:
+    """Rebuild the in-memory indexes from SQLite; rows arrive oldest first."""
+    docs = [
+        _coerce(orjson.loads(doc))
+        for (doc,) in _SQL.execute("SELECT doc FROM invoices ORDER BY sortTs")
+    ]
+    with _MEM_LOCK:
+        by_user: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        for d in docs:
+            MEM_STORE[d["id"]] = d
+            by_user[d["userId"]].append(d)
+        for user_id, user_docs in by_user.items():
+            MEM_LIST[user_id].update(user_docs)
+        MEM_ALL.update(docs)
+    return len(docs)
+
+
+if SQLITE_PATH and not _ensure_firebase():
+    try:
+        _SQL = _sql_open(SQLITE_PATH)
+        print(f"[store] SQLite persistence: {SQLITE_PATH} ({_sql_load()} invoices loaded)")
+    except Exception as e:
+        _SQL = None
+        print(f"[store] SQLite persistence disabled ({e}); memory only.")
+
+# ---------------------------------------------------------------------------
+# Firestore write-behind: queue single saves, commit them in batches
+# ---------------------------------------------------------------------------
+BATCH_MAX_OPS = 450            # Firestore allows 500 writes per batch
+BATCH_MAX_BYTES = 9 * 1024**2  # ... and 10 MiB per request; keep headroom
+BATCH_IDLE_S = 0.2             # commit once no new write arrived for this long
+WRITE_WORKERS = int(os.environ.get("STORE_WRITE_WORKERS", "40"))  # concurrent batch commits
+WRITE_RETRIES = 4
+WRITE_RETRY_S = 5.0            # re-queued (failed) writes are retried this often
+EXIT_FLUSH_S = float(os.environ.get("STORE_EXIT_FLUSH_S", "20"))  # max time spent saving queued writes at exit
+
+_PENDING: Dict[str, Dict[str, Any]] = {}   # id -> doc, insertion ordered
+_INFLIGHT: Dict[str, Dict[str, Any]] = {}  # id -> doc taken into a batch, until it commits
+_PENDING_LOCK = threading.Lock()
+_PENDING_EVENT = threading.Event()
+_WRITER: Optional[threading.Thread] = None
+_WRITE_POOL = ThreadPoolExecutor(max_workers=WRITE_WORKERS, thread_name_prefix="store-write")
+
+# Transient Firestore errors worth retrying with backoff (filled in by _ensure_firebase)
+_RETRYABLE: Tuple[type, ...] = ()
+
+
+def _approx_size(d: Dict[str, Any]) -> int:
+    """Rough payload size; the OCR text dominates everything else."""
+    return 2048 + sum(len(t.encode("utf-8")) for t in d.get("ocr_text") or [] if isinstance(t, str))
+
+
+def _take_batch() -> List[Tuple[str, Dict[str, Any]]]:
+    """
+    Move up to one batch worth of pending writes (oldest first) to _INFLIGHT.
+    Ids whose previous version is still in flight wait for the next batch, so
+    concurrent commits can never land an older version last.
+    """
+    with _PENDING_LOCK:
+        items: List[Tuple[str, Dict[str, Any]]] = []
+        size = 0
+        for inv_id, d in _PENDING.items():
+            if inv_id in _INFLIGHT:
+                continue
+            size += _approx_size(d)
+            if items and size > BATCH_MAX_BYTES:
+                break
+            items.append((inv_id, d))
+            if len(items) >= BATCH_MAX_OPS:
+                break
+        for inv_id, d in items:
+            # get_invoice reads both maps without the lock: publish before removing
+            _INFLIGHT[inv_id] = d
+            del _PENDING[inv_id]
+        return items
+
+
+def _commit(items: List[Tuple[str, Dict[str, Any]]]) -> None:
+    batch = DB.batch()
+    col = DB.collection("invoices")
+    for inv_id, d in items:
+        batch.set(col.document(inv_id), _persisted(d))
+    batch.commit()
+
+
+def _commit_with_retry(items: List[Tuple[str, Dict[str, Any]]]) -> None:
+    for attempt in range(WRITE_RETRIES):
+        try:
+            _commit(items)
+            return
+        except _RETRYABLE:
+            if attempt == WRITE_RETRIES - 1:
+                raise
+            time.sleep(0.1 * 2 ** attempt)
+
+
+def _write_batch(items: List[Tuple[str, Dict[str, Any]]]) -> None:
+    """
+    Commit one batch. Transient failures (Firestore unavailable) put the whole
+    batch back in the queue; any other error means a doc was rejected, so the
+    docs are written one by one and a single bad doc can't sink the rest.
+    """
+    failed: List[Tuple[str, Dict[str, Any]]] = []
+    try:
+        _commit_with_retry(items)
+    except _RETRYABLE:
+        failed = items
+    except Exception:
+        logging.warning("[store] batch write of %d invoices failed; writing one by one", len(items))
+        for item in items:
+            try:
+                _commit_with_retry([item])
+            except _RETRYABLE:
+                failed.append(item)  # Firestore unavailable: keep it queued
+            except Exception:
+                logging.exception("[store] Firestore rejected invoice %s; not saved", item[0])
+    _settle(items, failed)
+
+
+def _settle(items: List[Tuple[str, Dict[str, Any]]], failed: List[Tuple[str, Dict[str, Any]]]) -> None:
+    """Batch done: drop it from _INFLIGHT and re-queue failures (a newer save wins)."""
+    with _PENDING_LOCK:
+        for inv_id, d in items:
+            if _INFLIGHT.get(inv_id) is d:
+                del _INFLIGHT[inv_id]
+        for inv_id, d in failed:
+            _PENDING.setdefault(inv_id, d)
+        if failed:
+            logging.warning("[store] %d invoice writes re-queued", len(failed))
+        elif _PENDING:
+            _PENDING_EVENT.set()  # saves that waited for this batch to land
+    for inv_id, _ in items:
+        _GET_CACHE.pop(inv_id, None)  # a read racing the save may have cached the old version
+    # Listings cached while these docs were queued/in flight (list + chat caches)
+    # were read from Firestore without them: invalidate now that they landed
+    for user_id in {d.get("userId") for _, d in items}:
+        if user_id:
+            bump_user(user_id)
+
+
+def _submit(items: List[Tuple[str, Dict[str, Any]]]) -> Future:
+    try:
+        return _WRITE_POOL.submit(_write_batch, items)
+    except RuntimeError:  # pool already shut down (interpreter exit): commit inline
+        fut: Future = Future()
+        try:
+            _write_batch(items)
+            fut.set_result(None)
+        except Exception as e:
+            fut.set_exception(e)
+        return fut
+
+
+def flush(timeout: Optional[float] = None) -> None:
+    """
+    Commit every queued Firestore write now (graceful shutdown, tests).
+    With a timeout, no new batch is started and no more waiting is done once it
+    has passed; whatever is left stays queued.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    # Batches are committed concurrently so their round trips overlap
+    futures = []
+    while (deadline is None or time.monotonic() < deadline) and (items := _take_batch()):
+        futures.append((len(items), _submit(items)))
+    for n, fut in futures:
+        try:
+            fut.result(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        except FuturesTimeout:
+            logging.warning("[store] batch write of %d invoices still running; not waiting", n)
+        except Exception:
+            logging.exception("[store] batch write of %d invoices failed", n)
+
+
+def _writer_loop() -> None:
+    while True:
+        # Wake on new saves; re-queued failures are retried every WRITE_RETRY_S
+        if not _PENDING_EVENT.wait(WRITE_RETRY_S) and not _PENDING:
+            continue
+        # Keep collecting until the batch is full or writes go quiet
+        while len(_PENDING) < BATCH_MAX_OPS:
+            _PENDING_EVENT.clear()
+            if not _PENDING_EVENT.wait(BATCH_IDLE_S):
+                break
+        flush()
+
+
+def _enqueue_write(d: Dict[str, Any]) -> None:
+    global _WRITER
+    with _PENDING_LOCK:
+        _PENDING[d["id"]] = d
+        if _WRITER is None:
+            _WRITER = threading.Thread(target=_writer_loop, name="store-writer", daemon=True)
+            _WRITER.start()
+    _PENDING_EVENT.set()
+
+
+def _flush_at_exit() -> None:
+    # Bounded: with Firestore down every batch burns its retries, don't hang shutdown on it
+    deadline = time.monotonic() + EXIT_FLUSH_S
+    flush(EXIT_FLUSH_S)
+    if _PENDING and time.monotonic() < deadline:  # writes re-queued by the first pass get one more try
+        flush(deadline - time.monotonic())
+    if _PENDING or _INFLIGHT:
+        logging.error("[store] %d invoice writes could not be saved before exit", len(_PENDING) + len(_INFLIGHT))
+
+
+atexit.register(_flush_at_exit)
+
+
+def _page_key(d: Dict[str, Any]) -> Tuple[str, str]:
+    """(createdAt, id): the listing order, and what a page cursor points at."""
+    return str(d.get("createdAt") or ""), str(d.get("id") or "")
+
+
+def _unsaved(
+    user_id: Optional[str], before: Optional[Tuple[str, str]] = None
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Saved docs Firestore can't return yet (queued or in flight), newest version
+    per id, optionally only one user's and only those listed after the cursor
+    position `before` (a _page_key).
+    """
+    if not _PENDING and not _INFLIGHT:
+        return {}
+    with _PENDING_LOCK:
+        local = {**_INFLIGHT, **_PENDING}
+    return {
+        inv_id: d for inv_id, d in local.items()
+        if (not user_id or d.get("userId") == user_id)
+        and (before is None or _page_key(d) < before)
+    }
+
+
+def _with_unsaved(docs: List[Dict[str, Any]], local: Dict[str, Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Merge unsaved docs into a Firestore listing (newest first) so saves are read
+    back at once. Take `local` (_unsaved) *before* running the query: a doc that
+    commits in between is then either in `local` or in the query result.
+    """
+    if not local:
+        return docs
+    merged = [d for d in docs if d.get("id") not in local]
+    merged.extend(local.values())
+    merged.sort(key=_page_key, reverse=True)
+    return merged
 
 # ---------------------------------------------------------------------------
 # Public API
 # ---------------------------------------------------------------------------
 
+def bump_user(user_id: str) -> None:
+    """Mark a user's invoices as changed (invalidates caches keyed on user_version)."""
+    _USER_VERSIONS[user_id] = _USER_VERSIONS.get(user_id, 0) + 1
+
+
+def user_version(user_id: str) -> int:
+    """Current write counter for a user; changes whenever one of their invoices is saved."""
+    return _USER_VERSIONS.get(user_id, 0)
+
+
 def save_invoice(doc: Dict[str, Any]) -> str:
     """
     Create/overwrite invoice document.
     Always coerces the input to the expected schema.
+    On Firestore the write is queued and committed in the next batch.
     """
-    d = coerce_legacy(doc)
+    d = _coerce(doc)  # never trust a stamp on input: the caller may have edited it
+    bump_user(d["userId"])
 
-    if FIREBASE_READY and DB is not None:
-        DB.collection("invoices").document(d["id"]).set(d)
+    if _ensure_firebase():
+        _GET_CACHE.pop(d["id"], None)
+        _enqueue_write(d)
         return d["id"]
 
     # In-memory: only store dicts; never lists/other types
-    MEM_STORE[d["id"]] = d
+    _mem_put(d)
     return d["id"]
 
 
+def save_invoices_bulk(docs: List[Dict[str, Any]]) -> List[str]:
+    """
+    Create/overwrite many invoices at once (ingestion pipelines, backfills).
+    On Firestore the writes go through a BulkWriter, which batches and
+    parallelizes the RPCs instead of paying one round trip per document.
+    """
+    coerced = [_coerce(doc) for doc in docs]
+    users = {d["userId"] for d in coerced}
+    for user_id in users:
+        bump_user(user_id)
+
+    if _ensure_firebase():
+        bw = DB.bulk_writer()
+        col = DB.collection("invoices")
+        for d in coerced:
+            bw.set(col.document(d["id"]), _persisted(d))
+        bw.close()  # flushes and waits for all pending writes
+        # Reads during close() may have cached listings without the new docs
+        for user_id in users:
+            bump_user(user_id)
+        for d in coerced:
+            _GET_CACHE.pop(d["id"], None)
+        return [d["id"] for d in coerced]
+
+    for d in coerced:
+        _mem_put(d, persist=False)
+    if _SQL is not None:
+        with _MEM_LOCK:
+            _sql_write(coerced)
+    return [d["id"] for d in coerced]
+
+
+# Short-lived cache for Firestore detail reads (detail pages poll/refetch).
+# save_invoice drops the entry, so a process never reads its own stale write.
+GET_CACHE_TTL = float(os.environ.get("STORE_GET_CACHE_TTL", "30"))
+GET_CACHE_MAX = 4096
+_GET_CACHE: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+
+
 def get_invoice(invoice_id: str) -> Optional[Dict[str, Any]]:
     """Fetch a single invoice by id."""
-    if FIREBASE_READY and DB is not None:
+    if _ensure_firebase():
+        pending = _PENDING.get(invoice_id) or _INFLIGHT.get(invoice_id)  # saved, not committed yet
+        if pending is not None:
+            return pending
+        now = time.monotonic()
+        hit = _GET_CACHE.get(invoice_id)
+        if hit and now - hit[0] < GET_CACHE_TTL:
+            return hit[1]
         snap = DB.collection("invoices").document(invoice_id).get()
-        return snap.to_dict() if snap.exists else None
+        if not snap.exists:
+            return None
+        doc = snap.to_dict()
+        doc.pop("_coerced", None)  # written by older versions; recompute on read
+        if invoice_id not in _GET_CACHE and len(_GET_CACHE) >= GET_CACHE_MAX:
+            _GET_CACHE.pop(next(iter(_GET_CACHE)), None)  # evict oldest entry
+        _GET_CACHE[invoice_id] = (now, doc)
+        return doc
+    # In-memory: MEM_STORE is already an O(1) dict lookup
     return MEM_STORE.get(invoice_id)
 
 
-def list_invoices_for_user(user_id: Optional[str]) -> List[Dict[str, Any]]:
+def _limit(docs: List[Dict[str, Any]], limit: Optional[int]) -> List[Dict[str, Any]]:
+    return docs[:limit] if limit else docs
+
+
+def _stream_dicts(q) -> List[Dict[str, Any]]:
+    """Run a query into plain dicts with their document id (to_dict() already copies)."""
+    docs: List[Dict[str, Any]] = []
+    append = docs.append
+    for snap in q.stream():
+        r = snap.to_dict()
+        r.pop("_coerced", None)  # written by older versions; recompute on read
+        r["id"] = snap.id
+        append(r)
+    return docs
+
+
+def _invoice_query(user_id: Optional[str]):
+    """Firestore query for a user's (or all) invoices, newest first (ties by doc id)."""
+    q = DB.collection("invoices")
+    if user_id:
+        # New API preferred (no warnings); fallback to legacy where()
+        if HAS_FIELD_FILTER:
+            q = q.where(filter=FieldFilter("userId", "==", user_id))
+        else:
+            q = q.where("userId", "==", user_id)
+    return q.order_by("createdAt", direction=firestore.Query.DESCENDING) \
+        .order_by("__name__", direction=firestore.Query.DESCENDING)
+
+
+def backfill_created_at() -> int:
     """
-    List invoices, optionally filtered by userId, newest first.
-    Robust against accidental non-dict values in MEM_STORE.
+    One-off Firestore migration for legacy invoices; returns how many were updated.
+
+    _invoice_query orders by createdAt server-side, and Firestore leaves out
+    documents without that field and sorts Timestamps/numbers apart from
+    strings. This rewrites createdAt as an ISO string: converted from a
+    Timestamp/number, or taken from the document's create_time when missing.
+    Run once after deploying: python store.py backfill-created-at
     """
-    if FIREBASE_READY and DB is not None:
-        q = DB.collection("invoices")
+    if not _ensure_firebase():
+        return 0
+    updated, pending = 0, []
+    for snap in DB.collection("invoices").select(["createdAt"]).stream():
+        raw = (snap.to_dict() or {}).get("createdAt")
+        if isinstance(raw, str) and raw:
+            continue
+        iso = None
+        if raw is not None:
+            try:
+                iso = _norm_created(raw)
+            except Exception:
+                pass  # unconvertible legacy value (overflow, nan, ...): use create_time
+        if not (isinstance(iso, str) and iso):
+            ct = getattr(snap, "create_time", None)
+            iso = _norm_created(ct) if ct is not None else _iso_now()
+        pending.append((snap.reference, iso))
+        if len(pending) >= BATCH_MAX_OPS:
+            updated += _apply_created_at(pending)
+            pending = []
+    if pending:
+        updated += _apply_created_at(pending)
+    return updated
+
+
+def _apply_created_at(pending: List[Tuple[Any, str]]) -> int:
+    batch = DB.batch()
+    for ref, iso in pending:
+        batch.update(ref, {"createdAt": iso})
+    batch.commit()
+    return len(pending)
+
+
+# Per-user Firestore listings, reused while fresh so a polling frontend costs one
+# query per TTL. Entries carry user_version, which is bumped when a save is
+# queued and again when its batch commits, so this process never serves a
+# listing taken before its own write landed; the TTL bounds staleness from
+# other instances.
+LIST_CACHE_TTL = float(os.environ.get("STORE_LIST_CACHE_TTL", "5"))
+LIST_CACHE_MAX = 1024
+_LIST_CACHE: Dict[Tuple[str, Optional[int]], Tuple[float, int, List[Dict[str, Any]]]] = {}
+
+
+def list_invoices_for_user(user_id: Optional[str], limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    List invoices, optionally filtered by userId, newest first (at most `limit`).
+    In memory this reads the sorted indexes maintained by save_invoice.
+
+    Firestore sorts and limits server-side; filtering by userId needs the
+    composite index (userId ASC, createdAt DESC).
+    """
+    if _ensure_firebase():
+        key = (user_id, limit)
+        now = time.monotonic()
+        version = user_version(user_id) if user_id else 0
+        hit = _LIST_CACHE.get(key) if user_id else None
+        local = _unsaved(user_id)
+        if hit and hit[1] == version and now - hit[0] < LIST_CACHE_TTL:
+            return _limit(_with_unsaved(list(hit[2]), local), limit)
+
+        q = _invoice_query(user_id)
+        if limit:
+            q = q.limit(limit)
+        docs = _stream_dicts(q)
         if user_id:
-            # New API preferred (no warnings); fallback to legacy where()
-            if HAS_FIELD_FILTER:
-                q = q.where(filter=FieldFilter("userId", "==", user_id))
-            else:
-                q = q.where("userId", "==", user_id)
-        docs = [{**d.to_dict(), "id": d.id} for d in q.stream()]
-        docs.sort(key=lambda x: str(x.get("createdAt") or ""), reverse=True)
-        return docs
+            if key not in _LIST_CACHE and len(_LIST_CACHE) >= LIST_CACHE_MAX:
+                _LIST_CACHE.pop(next(iter(_LIST_CACHE)), None)  # evict oldest entry
+            _LIST_CACHE[key] = (now, version, docs)
+        return _limit(_with_unsaved(list(docs), local), limit)
 
-    # -------- In-memory (robust) --------
-    results: List[Dict[str, Any]] = []
-    warned = False
-
-    for v in MEM_STORE.values():
-        if isinstance(v, dict):
-            if not user_id or v.get("userId") == user_id:
-                results.append(v)
-        elif isinstance(v, list):
-            # if someone accidentally stored a list, try to harvest dicts inside
-            for item in v:
-                if isinstance(item, dict) and (not user_id or item.get("userId") == user_id):
-                    results.append(item)
-        else:
-            if not warned:
-                logging.warning("MEM_STORE contains a non-dict/list value: %r", type(v))
-                warned = True
+    # -------- In-memory: per-user index is already sorted --------
+    if user_id:
+        lst = MEM_LIST.get(user_id)  # .get: don't create entries for unknown users
+        return _newest_first(lst, limit) if lst else []
+
+    # -------- In-memory, all users: global index is already sorted --------
+    newest = reversed(MEM_ALL)
+    return list(islice(newest, limit) if limit else newest)
+
+
+# Fields a listing UI needs; leaves out the (potentially large) ocr_text pages.
+SUMMARY_FIELDS = (
+    "id", "userId", "vendor", "date", "amount", "currency",
+    "filename", "createdAt", "fraud_score", "docType",
+)
+
+
+def list_invoices_summary(user_id: Optional[str], limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Like list_invoices_for_user, but only SUMMARY_FIELDS are returned.
+    Firestore projects server-side with select(), so ocr_text is never downloaded.
+    Use get_invoice for the full document.
+    """
+    if _ensure_firebase():
+        local = _unsaved(user_id)
+        q = _invoice_query(user_id).select(list(SUMMARY_FIELDS))
+        if limit:
+            q = q.limit(limit)
+        docs = _stream_dicts(q)
+        merged = _with_unsaved(docs, local)
+        if merged is docs:
+            return docs
+        return [{k: d[k] for k in SUMMARY_FIELDS if k in d} for d in _limit(merged, limit)]
+
+    return [
+        {k: d[k] for k in SUMMARY_FIELDS if k in d}
+        for d in list_invoices_for_user(user_id, limit)
+    ]
+
+
+def list_invoices_page(
+    user_id: Optional[str], page_size: int = 50, cursor: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    One page of invoices, newest first: {"items": [...], "next_cursor": str | None}.
+    Pass next_cursor back to get the following page; None means no more pages.
 
-    results.sort(key=lambda x: str(x.get("createdAt") or ""), reverse=True)
-    return results
+    The cursor is "<createdAt>|<id>" of the last item: invoices sharing a
+    createdAt (bulk uploads) are ordered by id, so none are skipped or repeated
+    across a page boundary.
+
+    Firestore pages server-side (order_by + limit + start_after), so a call
+    reads page_size documents instead of the whole collection. Filtering by
+    userId needs the composite index (userId ASC, createdAt DESC).
+    """
+    # A cursor without "|" (createdAt only) resumes after every invoice at that time
+    after = cursor.rpartition("|")[::2] if cursor and "|" in cursor else (cursor, "")
+    if _ensure_firebase():
+        q = _invoice_query(user_id).limit(page_size)
+        if cursor:
+            # Values follow the order_by fields: createdAt, then the doc reference
+            q = q.start_after(
+                [after[0], DB.collection("invoices").document(after[1])] if after[1] else [after[0]]
+            )
+        local = _unsaved(user_id, before=after if cursor else None)
+        fetched = _stream_dicts(q)
+        items = _with_unsaved(fetched, local)
+        more = len(fetched) == page_size or len(items) > page_size
+        items = items[:page_size]
+        last = "|".join(_page_key(items[-1])) if more and items else None
+        return {"items": items, "next_cursor": last}
+
+    # In memory: the indexes are sorted oldest first on (_sort_ts, id)
+    if user_id and user_id not in MEM_LIST:
+        return {"items": [], "next_cursor": None}
+    idx = MEM_LIST[user_id] if user_id else MEM_ALL
+    newest = idx.irange_key(max_key=after, inclusive=(True, False), reverse=True) if cursor \
+        else reversed(idx)
+    items = list(islice(newest, page_size))
+    last = "|".join(_INDEX_KEY(items[-1])) if len(items) == page_size else None
+    return {"items": items, "next_cursor": last}
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["backfill-created-at"]:
+        print(f"[store] createdAt backfilled on {backfill_created_at()} invoices")
+    else:
+        print("usage: python store.py backfill-created-at")